@@ -1,4 +1,4 @@
-from .model import ROMPv1
+from .model import ROMPv1, CUDAGraphedROMP
 import cv2
 import numpy as np
 import os, sys
@@ -32,6 +32,10 @@ def romp_settings():
     parser.add_argument('--frame_rate', type=int, default=24, help = 'The frame_rate of saved video results')
     parser.add_argument('--smpl_path', type=str, default=osp.join(osp.expanduser("~"),'.romp','smpl_packed_info.pth'), help = 'The path of smpl model file')
     parser.add_argument('--model_path', type=str, default=osp.join(osp.expanduser("~"),'.romp','ROMP.pkl'), help = 'The path of ROMP checkpoint')
+    parser.add_argument('--compile', action='store_true', help = 'Whether to compile the backbone with torch.compile (PyTorch>=2.0) for faster inference')
+    parser.add_argument('--half', action='store_true', help = 'Whether to run the model in half precision (FP16) in GPU mode')
+    parser.add_argument('--cuda_graph', action='store_true', help = 'Whether to replay the model as a CUDA graph in GPU mode, ignored with --compile')
+    parser.add_argument('--cuda_streams', action='store_true', help = 'Whether to run the HRNet branches on separate CUDA streams in GPU mode, ignored with --compile')
     args = parser.parse_args()
 
     if not torch.cuda.is_available():
@@ -59,10 +63,20 @@ class ROMP(nn.Module):
     
     def _build_model_(self):
         model = ROMPv1().eval()
-        model.load_state_dict(torch.load(self.settings.model_path, map_location=self.tdevice))
-        model = model.to(self.tdevice)
+        model.load_state_dict(torch.load(self.settings.model_path, map_location='cpu'))
+        model = model.fuse().to(self.tdevice).to(memory_format=torch.channels_last)
+        if self.settings.half and self.settings.GPU > -1:
+            model = model.half()
+        if self.settings.cuda_streams and self.settings.GPU > -1 and not self.settings.compile:
+            model = model.parallelize_branches()
+        if self.settings.compile:
+            model.backbone = torch.compile(model.backbone, mode='reduce-overhead')
             
-        self.model = nn.DataParallel(model)
+        if self.settings.cuda_graph and self.settings.GPU > -1 and not self.settings.compile:
+            # not wrapped by DataParallel, whose per-call replicas would drop the captured graph
+            self.model = CUDAGraphedROMP(model)
+        else:
+            self.model = nn.DataParallel(model)
     
     def _initilization_(self):
         self.centermap_parser = CenterMap(conf_thresh=self.settings.center_thresh)
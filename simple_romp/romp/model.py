@@ -2,49 +2,82 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import inspect
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 def get_coord_maps(size=128):
-    xx_ones = torch.ones([1, size], dtype=torch.int32)
-    xx_ones = xx_ones.unsqueeze(-1)
-
-    xx_range = torch.arange(size, dtype=torch.int32).unsqueeze(0)
-    xx_range = xx_range.unsqueeze(1)
-
-    xx_channel = torch.matmul(xx_ones, xx_range)
-    xx_channel = xx_channel.unsqueeze(-1)
-
-    yy_ones = torch.ones([1, size], dtype=torch.int32)
-    yy_ones = yy_ones.unsqueeze(1)
-
-    yy_range = torch.arange(size, dtype=torch.int32).unsqueeze(0)
-    yy_range = yy_range.unsqueeze(-1)
-
-    yy_channel = torch.matmul(yy_range, yy_ones)
-    yy_channel = yy_channel.unsqueeze(-1)
-
-    xx_channel = xx_channel.permute(0, 3, 1, 2)
-    yy_channel = yy_channel.permute(0, 3, 1, 2)
-
-    xx_channel = xx_channel.float() / (size - 1)
-    yy_channel = yy_channel.float() / (size - 1)
-
-    xx_channel = xx_channel * 2 - 1
-    yy_channel = yy_channel * 2 - 1
-
-    out = torch.cat([xx_channel, yy_channel], dim=1)
-    return out
+    lin = torch.linspace(-1.0, 1.0, size)
+    yy_channel, xx_channel = torch.meshgrid(lin, lin, indexing='ij')
+    return torch.stack([xx_channel, yy_channel], 0).unsqueeze(0).contiguous()
 
 def BHWC_to_BCHW(x):
     """
     :param x: torch tensor, B x H x W x C
     :return:  torch tensor, B x C x H x W
     """
-    return x.unsqueeze(1).transpose(1, -1).squeeze(-1)
+    return x.permute(0, 3, 1, 2)
 
 
 BN_MOMENTUM = 0.1
+# cam scale is predicted as an exponent of 1.1, 1.1**x == exp(x * ln1.1)
+CAM_SCALE_LOG_BASE = math.log(1.1)
+
+@torch.no_grad()
+def fuse_conv_bn(conv, bn):
+    """Fold an inference-mode BatchNorm2d into the preceding Conv2d, return the fused Conv2d."""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size,
+                      stride=conv.stride, padding=conv.padding, dilation=conv.dilation,
+                      groups=conv.groups, bias=True, padding_mode=conv.padding_mode).to(conv.weight.device)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+    fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+def _conv_bias(conv):
+    return conv.bias if conv.bias is not None else torch.zeros(conv.out_channels, device=conv.weight.device)
+
+@torch.no_grad()
+def stack_convs(convs, groups=1):
+    """
+    Stack convs of the same kernel/stride along the output channels into a single Conv2d.
+    groups=1: all convs read the same input; groups=len(convs): conv k reads the k-th input slice.
+    """
+    conv = convs[0]
+    stacked = nn.Conv2d(conv.in_channels * groups, sum([c.out_channels for c in convs]), conv.kernel_size,
+                        stride=conv.stride, padding=conv.padding, groups=groups, bias=True).to(conv.weight.device)
+    stacked.weight.copy_(torch.cat([c.weight for c in convs], 0))
+    stacked.bias.copy_(torch.cat([_conv_bias(c) for c in convs], 0))
+    return stacked
+
+@torch.no_grad()
+def block_diagonal_conv(convs):
+    """Merge convs that read consecutive input slices into one Conv2d, even if their output channels differ."""
+    conv = convs[0]
+    merged = nn.Conv2d(sum([c.in_channels for c in convs]), sum([c.out_channels for c in convs]), conv.kernel_size,
+                       stride=conv.stride, padding=conv.padding, bias=True).to(conv.weight.device)
+    merged.weight.zero_()
+    out_start, in_start = 0, 0
+    for c in convs:
+        merged.weight[out_start:out_start+c.out_channels, in_start:in_start+c.in_channels] = c.weight
+        out_start, in_start = out_start + c.out_channels, in_start + c.in_channels
+    merged.bias.copy_(torch.cat([_conv_bias(c) for c in convs], 0))
+    return merged
+
+def scale_cam_maps(params_maps):
+    """Turn the first channel of params_maps, the predicted cam scale exponent, into the always positive 1.1**x."""
+    if torch.onnx.is_in_onnx_export():
+        # writing into a channel exports as a ScatterND, rebuild the maps with a concat instead
+        return torch.cat([params_maps[:, 0:1].mul(CAM_SCALE_LOG_BASE).exp(), params_maps[:, 1:]], 1)
+    params_maps[:, 0:1].mul_(CAM_SCALE_LOG_BASE).exp_()
+    return params_maps
+
+# kept as a single float32 call by FX graph mode tools (e.g. quantization), which would drop its inplace ops
+torch.fx.wrap('scale_cam_maps')
 
 def conv3x3(in_planes, out_planes, stride=1):
     """3x3 convolution with padding"""
@@ -126,6 +159,21 @@ blocks_dict = {
     'BASIC': BasicBlock,
     'BOTTLENECK': Bottleneck}
 
+class UpsampleAdd(nn.Sequential):
+    """
+    1x1 conv + BN of a lower resolution branch, nearest upsampled by scale_factor and added onto
+    the higher resolution map y, in place if inplace.
+    """
+    def __init__(self, inchannels, outchannels, scale_factor):
+        super(UpsampleAdd, self).__init__(
+            nn.Conv2d(inchannels, outchannels, 1, 1, 0, bias=False),
+            nn.BatchNorm2d(outchannels))
+        self.scale_factor = scale_factor
+
+    def forward(self, x, y, inplace=False):
+        x = F.interpolate(super(UpsampleAdd, self).forward(x), scale_factor=self.scale_factor, mode='nearest')
+        return y.add_(x) if inplace else y + x
+
 class HighResolutionModule(nn.Module):
     def __init__(self, num_branches, blocks, num_blocks, num_inchannels,
                  num_channels, fuse_method, multi_scale_output=True):
@@ -141,6 +189,13 @@ class HighResolutionModule(nn.Module):
             num_branches, blocks, num_blocks, num_channels)
         self.fuse_layers = self._make_fuse_layers()
         self.relu = nn.ReLU(True)
+        # filled by merge_fuse_convs(), convs shared by the fuse layers reading the same branch
+        self.shared_fuse_convs = nn.ModuleList()
+        self.shared_fuse_splits = []
+        # set by ROMPv1.parallelize_branches(), run the branches on their own CUDA streams.
+        # The streams are kept per device in a dict that nn.DataParallel replicas share with this module
+        self.parallel_branches = False
+        self.branch_streams = {}
 
     def _make_one_branch(self, branch_index, block, num_blocks, num_channels,
                          stride=1):
@@ -186,15 +241,9 @@ class HighResolutionModule(nn.Module):
             fuse_layer = []
             for j in range(num_branches):
                 if j > i:
-                    fuse_layer.append(nn.Sequential(
-                        nn.Conv2d(num_inchannels[j],
-                                  num_inchannels[i],
-                                  1,
-                                  1,
-                                  0,
-                                  bias=False),
-                        nn.BatchNorm2d(num_inchannels[i]),
-                        nn.Upsample(scale_factor=2**(j-i), mode='nearest')))
+                    fuse_layer.append(UpsampleAdd(num_inchannels[j],
+                                                  num_inchannels[i],
+                                                  2**(j-i)))
                 elif j == i:
                     fuse_layer.append(None)
                 else:
@@ -223,22 +272,85 @@ class HighResolutionModule(nn.Module):
     def get_num_inchannels(self):
         return self.num_inchannels
 
+    @torch.no_grad()
+    def merge_fuse_convs(self):
+        """
+        After BN folding, merge the fuse layer convs reading the same branch into one conv,
+        each fuse layer then takes its slice of the merged output:
+        the 1x1 convs of the upsampling fuse layers and the first 3x3 stride-2 convs of the downsampling ones.
+        """
+        if self.fuse_layers is None:
+            return
+        for j in range(self.num_branches):
+            up_targets = list(range(min(j, len(self.fuse_layers))))
+            if len(up_targets) > 1:
+                self._share_fuse_convs(j, up_targets, [self.fuse_layers[i][j] for i in up_targets])
+            down_targets = list(range(j + 1, len(self.fuse_layers)))
+            if len(down_targets) > 1:
+                self._share_fuse_convs(j, down_targets, [self.fuse_layers[i][j][0] for i in down_targets])
+
+    def _share_fuse_convs(self, j, targets, layers):
+        convs = [layer[0] for layer in layers]
+        self.shared_fuse_convs.append(stack_convs(convs))
+        self.shared_fuse_splits.append((j, targets, [conv.out_channels for conv in convs]))
+        for layer in layers:
+            layer[0] = nn.Identity()
+
+    def _run_branches(self, x):
+        if not (self.parallel_branches and x[0].is_cuda):
+            return [branch(x_i) for branch, x_i in zip(self.branches, x)]
+        device = x[0].device
+        if device not in self.branch_streams:
+            self.branch_streams[device] = [torch.cuda.Stream(device=device) for _ in self.branches]
+        branch_streams = self.branch_streams[device]
+        # fork / join with stream dependencies only, which also stays valid under CUDA graph capture
+        current_stream = torch.cuda.current_stream(device)
+        outputs = []
+        for branch, x_i, stream in zip(self.branches, x, branch_streams):
+            stream.wait_stream(current_stream)
+            x_i.record_stream(stream)
+            with torch.cuda.stream(stream):
+                outputs.append(branch(x_i))
+        for output, stream in zip(outputs, branch_streams):
+            current_stream.wait_stream(stream)
+            output.record_stream(current_stream)
+        return outputs
+
+    def _shared_fuse_inputs(self, x):
+        fuse_inputs = {}
+        for conv, (j, targets, split_sizes) in zip(self.shared_fuse_convs, self.shared_fuse_splits):
+            if torch.onnx.is_in_onnx_export():
+                # a Split of the merged output blocks onnxruntime's NCHWc layout pass, export one conv per fuse layer
+                starts = [sum(split_sizes[:k]) for k in range(len(split_sizes) + 1)]
+                x_j = [F.conv2d(x[j], conv.weight[start:end], conv.bias[start:end], conv.stride, conv.padding)
+                       for start, end in zip(starts[:-1], starts[1:])]
+            else:
+                x_j = conv(x[j]).split(split_sizes, 1)
+            for k, i in enumerate(targets):
+                fuse_inputs[i, j] = x_j[k]
+        return fuse_inputs
+
     def forward(self, x):
         if self.num_branches == 1:
             return [self.branches[0](x[0])]
 
-        for i in range(self.num_branches):
-            x[i] = self.branches[i](x[i])
+        x = self._run_branches(x)
+        fuse_inputs = self._shared_fuse_inputs(x)
 
         x_fuse = []
 
         for i in range(len(self.fuse_layers)):
-            y = x[0] if i == 0 else self.fuse_layers[i][0](x[0])
+            y = x[0] if i == 0 else self.fuse_layers[i][0](fuse_inputs.get((i, 0), x[0]))
             for j in range(1, self.num_branches):
+                # the first addition allocates the output of row i, the following ones accumulate into it
+                inplace = j > 1
                 if i == j:
-                    y = y + x[j]
+                    y = y.add_(x[j]) if inplace else y + x[j]
+                elif j > i:
+                    y = self.fuse_layers[i][j](fuse_inputs.get((i, j), x[j]), y, inplace)
                 else:
-                    y = y + self.fuse_layers[i][j](x[j])
+                    x_ij = self.fuse_layers[i][j](fuse_inputs.get((i, j), x[j]))
+                    y = y.add_(x_ij) if inplace else y + x_ij
             x_fuse.append(self.relu(y))
 
         return x_fuse
@@ -250,6 +362,7 @@ class HigherResolutionNet(nn.Module):
         super(HigherResolutionNet, self).__init__()
         self.make_baseline()
         self.backbone_channels = 32
+        self.normalize_input = True
 
     def _make_transition_layer(
             self, num_channels_pre_layer, num_channels_cur_layer):
@@ -379,9 +492,29 @@ class HigherResolutionNet(nn.Module):
         self.stage4, pre_stage_channels = self._make_stage(
             self.stage4_cfg, num_channels, multi_scale_output=False)
 
+    @torch.no_grad()
+    def fuse_input_normalization(self):
+        """
+        Absorb the (x / 255.) * 2 - 1 input scaling into the weights and bias of conv1.
+        The zero padding of conv1 is replaced by padding the raw input with 127.5, which is what 0 maps back to.
+        """
+        scale, shift = 2. / 255., -1.
+        conv = self.conv1
+        fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size,
+                          stride=conv.stride, padding=0, bias=True).to(conv.weight.device)
+        bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels, device=conv.weight.device)
+        fused.weight.copy_(conv.weight * scale)
+        fused.bias.copy_(bias + conv.weight.sum(dim=(1, 2, 3)) * shift)
+        pad_h, pad_w = conv.padding
+        self.conv1 = nn.Sequential(nn.ConstantPad2d((pad_w, pad_w, pad_h, pad_h), -shift / scale), fused)
+        self.normalize_input = False
+
     @torch.no_grad()
     def forward(self, x):
-        x = ((BHWC_to_BCHW(x)/ 255.) * 2.0 - 1.0).contiguous()
+        # the input already arrives as B x H x W x C, so channels_last needs no copy
+        x = BHWC_to_BCHW(x).contiguous(memory_format=torch.channels_last)
+        if self.normalize_input:
+            x = (x / 255.) * 2.0 - 1.0
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -390,39 +523,57 @@ class HigherResolutionNet(nn.Module):
         x = self.relu(x)
         x = self.layer1(x)
 
-        x_list = []
-        for i in range(self.stage2_cfg['NUM_BRANCHES']):
-            if self.transition1[i] is not None:
-                x_list.append(self.transition1[i](x))
-            else:
-                x_list.append(x)
+        x_list = [x if transition is None else transition(x) for transition in self.transition1]
         y_list = self.stage2(x_list)
 
-        x_list = []
-        for i in range(self.stage3_cfg['NUM_BRANCHES']):
-            if self.transition2[i] is not None:
-                x_list.append(self.transition2[i](y_list[-1]))
-            else:
-                x_list.append(y_list[i])
+        x_list = [y_list[i] if transition is None else transition(y_list[-1]) \
+            for i, transition in enumerate(self.transition2)]
         y_list = self.stage3(x_list)
 
-        x_list = []
-        for i in range(self.stage4_cfg['NUM_BRANCHES']):
-            if self.transition3[i] is not None:
-                x_list.append(self.transition3[i](y_list[-1]))
-            else:
-                x_list.append(y_list[i])
+        x_list = [y_list[i] if transition is None else transition(y_list[-1]) \
+            for i, transition in enumerate(self.transition3)]
         y_list = self.stage4(x_list)
         x = y_list[0]
         return x
 
 
+class FusedHeads(nn.Module):
+    """
+    Parallel heads built by ROMPv1._make_head_layers, merged into one trunk after BN folding.
+    The stems read the same input and are stacked along the output channels, the BasicBlocks
+    run as grouped convs (one group per head) and the 1x1 projections as one block-diagonal conv.
+    The output channels follow the order of the given heads.
+    """
+    def __init__(self, heads):
+        super(FusedHeads, self).__init__()
+        num_heads = len(heads)
+        self.stem = nn.Sequential(stack_convs([head[0][0] for head in heads]), nn.ReLU(inplace=True))
+
+        head_blocks = [[m for m in head[1:-1].modules() if isinstance(m, BasicBlock)] for head in heads]
+        blocks = []
+        for same_blocks in zip(*head_blocks):
+            num_channels = sum([block.conv1.out_channels for block in same_blocks])
+            block = BasicBlock(num_channels, num_channels)
+            block.conv1 = stack_convs([b.conv1 for b in same_blocks], groups=num_heads)
+            block.bn1 = nn.Identity()
+            block.conv2 = stack_convs([b.conv2 for b in same_blocks], groups=num_heads)
+            block.bn2 = nn.Identity()
+            blocks.append(block)
+        self.blocks = nn.Sequential(*blocks)
+        self.final_layer = block_diagonal_conv([head[-1] for head in heads])
+
+    def forward(self, x):
+        return self.final_layer(self.blocks(self.stem(x)))
+
+
 class ROMPv1(nn.Module):
     def __init__(self,**kwargs):
         super(ROMPv1, self).__init__()
         print('Using ROMP v1')
         self.backbone = HigherResolutionNet()
         self._build_head()
+        # inference only: BN has to use its running stats, that is also what fuse() folds into the convs
+        self.eval()
 
     def _build_head(self):
         self.outmap_size = 64
@@ -431,7 +582,9 @@ class ROMPv1(nn.Module):
         self.output_cfg = {'NUM_PARAMS_MAP':params_num-cam_dim, 'NUM_CENTER_MAP':1, 'NUM_CAM_MAP':cam_dim}
 
         self.final_layers = self._make_final_layers(self.backbone.backbone_channels)
-        self.coordmaps = get_coord_maps(128)
+        self.fused_head = None
+        # not persistent: it is a constant grid and absent from released checkpoints
+        self.register_buffer('coordmaps', get_coord_maps(128), persistent=False)
 
     def _make_final_layers(self, input_channels):
         final_layers = [None]
@@ -469,31 +622,172 @@ class ROMPv1(nn.Module):
     
     @torch.no_grad()
     def forward(self, image):
-        x = self.backbone(image)
-        x = torch.cat((x, self.coordmaps.to(x.device).repeat(x.shape[0],1,1,1)), 1)
-
-        params_maps = self.final_layers[1](x)
-        center_maps = self.final_layers[2](x)
-        cam_maps = self.final_layers[3](x)
-        # to make sure that scale is always a positive value
-        cam_maps[:, 0] = torch.pow(1.1,cam_maps[:, 0])
-        params_maps = torch.cat([cam_maps, params_maps], 1)
+        # run in the precision of the model (e.g. after .half()), the outputs are always float32
+        x = self.backbone(image.to(self.coordmaps.dtype))
+        x = torch.cat((x, self.coordmaps.expand_as(x[:, :2])), 1)
+
+        if self.fused_head is not None:
+            # the heads are merged in [cam, params, center] order, so params_maps needs no concat
+            params_maps, center_maps = self.fused_head(x).float().split(
+                [self.output_cfg['NUM_CAM_MAP'] + self.output_cfg['NUM_PARAMS_MAP'], self.output_cfg['NUM_CENTER_MAP']], 1)
+        else:
+            params_maps = self.final_layers[1](x).float()
+            center_maps = self.final_layers[2](x).float()
+            cam_maps = self.final_layers[3](x).float()
+            params_maps = torch.cat([cam_maps, params_maps], 1)
+        params_maps = scale_cam_maps(params_maps)
         return center_maps, params_maps 
 
+    def parallelize_branches(self):
+        """Run the independent branches of every HRNet module on separate CUDA streams."""
+        for module in self.backbone.modules():
+            if isinstance(module, HighResolutionModule):
+                module.parallel_branches = True
+        return self
+
+    @torch.no_grad()
+    def quantize(self, calib_images, backend='x86'):
+        """
+        Post-training static INT8 quantization in torch.ao FX graph mode, with per-channel conv weights.
+        Call it on the fused model, calib_images is an iterable of representative B x 512 x 512 x 3 images.
+        Return a quantized copy for CPU inference, taking the same inputs and giving float32 maps.
+        """
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        calib_images = [image.cpu().float() for image in calib_images]
+        prepared = prepare_fx(copy.deepcopy(self).cpu().float().eval(), get_default_qconfig_mapping(backend),
+                              example_inputs=(calib_images[0],))
+        for image in calib_images:
+            prepared(image)
+        return convert_fx(prepared)
+
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Fold every Conv2d -> BatchNorm2d pair into a single Conv2d for inference,
+        as well as the input normalization into the first conv of the backbone,
+        merge the convs of the HRNet fuse layers sharing an input, and merge the three heads into one FusedHeads trunk.
+        It changes the state_dict layout, so call it after loading the checkpoint.
+        Calling it on an already fused model does nothing.
+        """
+        if self.fused_head is not None:
+            return self
+        for module in list(self.modules()):
+            pre_name, pre_child = None, None
+            for name, child in list(module.named_children()):
+                if isinstance(child, nn.BatchNorm2d) and isinstance(pre_child, nn.Conv2d):
+                    setattr(module, pre_name, fuse_conv_bn(pre_child, child))
+                    setattr(module, name, nn.Identity())
+                pre_name, pre_child = name, child
+        self.backbone.fuse_input_normalization()
+        for module in self.backbone.modules():
+            if isinstance(module, HighResolutionModule):
+                module.merge_fuse_convs()
+        self.fused_head = FusedHeads([self.final_layers[3], self.final_layers[1], self.final_layers[2]])
+        self.final_layers = None
+        return self
+
+
+class CUDAGraphedROMP(nn.Module):
+    """
+    Replay a (fused) ROMPv1 as a CUDA graph captured for the first input shape, which removes the launch
+    overhead of its many small kernels. CPU inputs or inputs of another shape run the eager model.
+    """
+    def __init__(self, model, warmup_iters=3):
+        super(CUDAGraphedROMP, self).__init__()
+        self.model = model
+        self.warmup_iters = warmup_iters
+        self.graph = None
+
+    @torch.no_grad()
+    def _capture(self, image):
+        self.static_input = image.clone()
+        # warm up on a side stream, as required before capturing
+        stream = torch.cuda.Stream(device=image.device)
+        stream.wait_stream(torch.cuda.current_stream(image.device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self.model(self.static_input)
+        torch.cuda.current_stream(image.device).wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_outputs = self.model(self.static_input)
+
+    @torch.no_grad()
+    def forward(self, image):
+        if image.device.type != 'cuda' or (self.graph is not None and \
+            (image.shape != self.static_input.shape or image.device != self.static_input.device)):
+            return self.model(image)
+        # streams, capture and replay all use the current device, make it the one of the model and input
+        with torch.cuda.device(image.device):
+            if self.graph is None:
+                self._capture(image)
+            self.static_input.copy_(image)
+            self.graph.replay()
+        # the static outputs are overwritten by the next replay
+        return tuple([output.clone() for output in self.static_outputs])
+
+
+def _torchscript_exporter_kwargs():
+    "torch>=2.5 may default to the dynamo exporter, which can not keep the fused model at opset 17"
+    return {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
 
 def export_model_to_onnx_static(model, save_file, bs=1):
-    image = torch.rand(1,512,512,3).cuda()
+    model.eval()
+    image = torch.rand(bs,512,512,3).cuda()
+    torch.onnx.export(model, (image),
+                      save_file, 
+                      input_names=['image'],
+                      output_names=['center_maps', 'params_maps'],
+                      export_params=True,
+                      opset_version=17,
+                      do_constant_folding=True,
+                      **_torchscript_exporter_kwargs())
+    print('ROMP onnx saved into: ', save_file)
+
+def export_model_to_onnx_dynamic(model, save_file, bs=2):
+    "support dynamic batch size, traced with bs>1 since a batch of 1 could be specialized as a constant"
+    model.eval()
+    image = torch.rand(bs,512,512,3).cuda()
+    dynamic_axes = {'image':[0], 'center_maps':[0], 'params_maps':[0]}
     torch.onnx.export(model, (image),
                       save_file, 
                       input_names=['image'],
                       output_names=['center_maps', 'params_maps'],
                       export_params=True,
-                      opset_version=12,
-                      do_constant_folding=True)
+                      opset_version=17,
+                      do_constant_folding=True,
+                      dynamic_axes=dynamic_axes,
+                      **_torchscript_exporter_kwargs())
     print('ROMP onnx saved into: ', save_file)
 
+def optimize_onnx_model(onnx_file, save_file):
+    """
+    Simplify the exported graph with onnxsim (if installed), then let onnxruntime apply all graph optimizations,
+    e.g. Conv+Add+ReLU fusion of the residual blocks, and save the result for deployment.
+    """
+    import onnx, onnxruntime
+    try:
+        import onnxsim
+        simplified_model, check = onnxsim.simplify(onnx.load(onnx_file))
+        if check:
+            onnx.save(simplified_model, save_file)
+            onnx_file = save_file
+    except ImportError:
+        print('onnxsim is not installed, skip simplifying the onnx graph.')
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.optimized_model_filepath = save_file
+    # compiling providers such as TensorRT can not serialize their fused graph, so optimize it for CUDA / CPU
+    providers = [provider for provider in ['CUDAExecutionProvider', 'CPUExecutionProvider'] \
+        if provider in onnxruntime.get_available_providers()]
+    onnxruntime.InferenceSession(onnx_file, sess_options, providers=providers)
+    print('Optimized ROMP onnx saved into: ', save_file)
+
 def test_model():
     model = ROMPv1().cuda()
+    model.eval()
     state_dict = torch.load('/home/yusun/ROMP/trained_models/ROMP.pkl')
     model.load_state_dict(state_dict) #, strict=False
     outputs = model(torch.rand(1,512,512,3).cuda())
@@ -506,8 +800,10 @@ def test_model():
             print(key, value.shape)
 
 if __name__ == '__main__':
-    model = ROMPv1().cuda()
-    state_dict = torch.load('/home/yusun/ROMP/trained_models/ROMP.pkl')
+    model = ROMPv1()
+    state_dict = torch.load('/home/yusun/ROMP/trained_models/ROMP.pkl', map_location='cpu')
     model.load_state_dict(state_dict)
+    model = model.fuse().cuda().half()
     save_file = '/home/yusun/ROMP/trained_models/ROMP.onnx'
-    export_model_to_onnx_static(model, save_file, bs=1)
\ No newline at end of file
+    export_model_to_onnx_dynamic(model, save_file)
+    optimize_onnx_model(save_file, save_file.replace('.onnx', '_optimized.onnx'))
\ No newline at end of file